@@ -1,8 +1,27 @@
 #!/usr/bin/env python3
 import os
-import json
+import orjson
+import time
 import argparse
-from openai import OpenAI
+import asyncio
+import httpx
+import ijson
+import openai
+from openai import AsyncOpenAI
+from tenacity import (
+    retry,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_exponential_jitter,
+)
+
+from grok_cache import ResponseCache
+
+JUDGE_MODEL = "grok-4-fast-non-reasoning"
+
+# Prompts are deterministic functions of the (static) result file, so cached
+# judge outputs can be replayed for free on re-runs.
+CACHE = ResponseCache(".grok_cache")
 
 SYSTEM_PROMPT = """
 You are a strict airline agent policy evaluator.
@@ -40,66 +59,306 @@ def parse_args():
         default="judged",
         help="Directory to write per-episode judge outputs (default: judged).",
     )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=16,
+        help="Maximum number of in-flight judge calls (default: 16).",
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Submit via the Batch API (cheaper, up to 24h turnaround) instead of real-time calls.",
+    )
     return parser.parse_args()
 
 
-def make_client() -> OpenAI:
+def iter_episodes(path: str):
+    """
+    Stream episodes from a τ-Bench result file one at a time instead of
+    loading the whole array, keeping peak memory proportional to the
+    in-flight episodes rather than the file size.
+
+    use_float=True: ijson otherwise yields decimal.Decimal for JSON floats
+    (every episode has a float reward), which orjson refuses to serialize.
+    """
+    with open(path, "rb") as f:
+        yield from ijson.items(f, "item", use_float=True)
+
+
+def make_client() -> AsyncOpenAI:
     api_key = os.getenv("XAI_API_KEY")
     if not api_key:
         raise RuntimeError("Please set the XAI_API_KEY environment variable.")
-    client = OpenAI(
+    # Configure the SDK's transport explicitly: one pool sized for the
+    # fan-out guarantees TCP reuse across all episodes and can't be exhausted
+    # by parallel scoring, and the generous timeout covers long trajectories.
+    client = AsyncOpenAI(
         api_key=api_key,
         base_url="https://api.x.ai/v1",
+        http_client=httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=64),
+            timeout=httpx.Timeout(120.0),
+            # multiplex concurrent judge calls over few connections
+            # (requires the httpx[http2] extra)
+            http2=True,
+        ),
     )
     return client
 
 
-def score_episode(client: OpenAI, ep: dict) -> str:
+async def prewarm_connections(client: AsyncOpenAI, n: int):
+    """
+    Open `n` warm sockets to api.x.ai before scoring starts, so the first wave
+    of judge calls doesn't pay cold DNS + TLS handshakes. A models listing is
+    the cheapest request the endpoint serves.
+    """
+
+    async def one():
+        try:
+            await client.models.list()
+        except Exception:
+            pass  # best-effort: a failed warm-up just means a cold first call
+
+    await asyncio.gather(*(one() for _ in range(n)))
+
+
+# Only transient failures are worth retrying; auth or bad-request errors
+# would fail identically on every attempt.
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def _is_retryable(exc: BaseException) -> bool:
+    if isinstance(exc, (openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    return (
+        isinstance(exc, openai.APIStatusError)
+        and exc.status_code in RETRYABLE_STATUS_CODES
+    )
+
+
+def _wait_retry_after(retry_state) -> float:
+    # Honor the server's Retry-After on 429/5xx; otherwise exponential backoff.
+    exc = retry_state.outcome.exception()
+    if isinstance(exc, openai.APIStatusError):
+        retry_after = exc.response.headers.get("retry-after")
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+    return wait_exponential_jitter(initial=1, max=32)(retry_state)
+
+
+# Trajectories can run to tens of KB of tool-call logs; since xAI bills per
+# input token, cap what we send. The judge needs the shape of the trajectory,
+# not every byte of every tool result.
+MAX_TRAJ_STEPS = 60
+MAX_FIELD_CHARS = 512
+MAX_CONTENT_TOKENS = 150_000  # ~4 chars per token
+
+
+def truncate_strings(obj, limit: int = MAX_FIELD_CHARS):
+    """Recursively cap string fields (tool results, message contents, ...)."""
+    if isinstance(obj, str) and len(obj) > limit:
+        return obj[:limit] + "...[truncated]"
+    if isinstance(obj, list):
+        return [truncate_strings(v, limit) for v in obj]
+    if isinstance(obj, dict):
+        return {k: truncate_strings(v, limit) for k, v in obj.items()}
+    return obj
+
+
+def build_judge_content(ep: dict) -> str:
+    """
+    Build the user message for one episode; shared by the real-time and
+    Batch API paths. The trajectory is step-capped and field-truncated, and
+    serialized compactly (indentation alone adds ~15% tokens).
+    """
     # User goal / instruction
     user_goal = ep["info"]["task"]["instruction"]
 
     model_actions = ep["info"]["task"].get("actions", [])
-    traj = ep.get("traj", [])
-
-    content = (
-        "USER GOAL:\n"
-        f"{user_goal}\n\n"
-        "EXECUTED TOOL ACTIONS (model):\n"
-        f"{json.dumps(model_actions, indent=2)}\n\n"
-        "FULL TRAJECTORY (if available):\n"
-        f"{json.dumps(traj, indent=2)}"
-    )
+    traj = truncate_strings(ep.get("traj", [])[:MAX_TRAJ_STEPS])
+
+    def render(traj_part: list) -> str:
+        return (
+            "USER GOAL:\n"
+            f"{user_goal}\n\n"
+            "EXECUTED TOOL ACTIONS (model):\n"
+            f"{orjson.dumps(model_actions).decode()}\n\n"
+            "FULL TRAJECTORY (if available):\n"
+            f"{orjson.dumps(traj_part).decode()}"
+        )
+
+    content = render(traj)
+    # Last-resort guard: drop trailing steps until we fit the token budget
+    while len(content) // 4 > MAX_CONTENT_TOKENS and traj:
+        traj = traj[: len(traj) // 2]
+        content = render(traj)
+    return content
 
-    resp = client.chat.completions.create(
-        model="grok-4-fast-non-reasoning", 
+
+@retry(
+    stop=stop_after_attempt(6),
+    wait=_wait_retry_after,
+    retry=retry_if_exception(_is_retryable),
+    reraise=True,
+)
+async def score_episode(client: AsyncOpenAI, ep: dict) -> str:
+    content = build_judge_content(ep)
+
+    # The request fully determines the (temperature-0) response, so key the
+    # cache on it and skip the API entirely on a hit.
+    cache_key = [JUDGE_MODEL, SYSTEM_PROMPT, content, 0.0]
+    cached = CACHE.get(cache_key)
+    if cached is not None:
+        return cached
+
+    resp = await client.chat.completions.create(
+        model=JUDGE_MODEL,
         messages=[
             {"role": "system", "content": SYSTEM_PROMPT},
             {"role": "user", "content": content},
         ],
         temperature=0.0,
     )
-    return resp.choices[0].message.content
+    result = resp.choices[0].message.content
+    CACHE.set(cache_key, result)
+    return result
 
 
-def main():
-    args = parse_args()
+async def run(args):
     client = make_client()
+    await prewarm_connections(client, args.concurrency)
 
     # Ensure output directory exists
     os.makedirs(args.output_dir, exist_ok=True)
 
-    # Load τ-Bench episodes
-    with open(args.input_file, "r") as f:
-        episodes = json.load(f)
+    def write_result(out_path: str, result: str):
+        # Write via a temp file so a crash can't leave a partial judge file
+        tmp_path = out_path + ".tmp"
+        with open(tmp_path, "w") as out_f:
+            out_f.write(result)
+        os.replace(tmp_path, out_path)
 
-    for ep in episodes:
+    async def score_one(ep: dict):
         task_id = ep.get("task_id", "unknown")
-        print(f"Scoring episode {task_id}...")
-        result = score_episode(client, ep)
+        result = await score_episode(client, ep)
 
         out_path = os.path.join(args.output_dir, f"{task_id}.txt")
+        # Hand the blocking write to a thread so filesystem latency doesn't
+        # stall the event loop and the other in-flight judge calls
+        await asyncio.to_thread(write_result, out_path, result)
+        print(f"Scored episode {task_id}")
+
+    # Streaming producer/consumer: episodes are parsed incrementally and fed
+    # to `concurrency` workers through a bounded queue, so the first judge
+    # call goes out before the input file has finished parsing and only the
+    # queued episodes are held in memory.
+    queue: asyncio.Queue = asyncio.Queue(maxsize=2 * args.concurrency)
+
+    async def worker():
+        while True:
+            ep = await queue.get()
+            if ep is None:
+                return
+            # Contain failures to the episode: an uncaught exception would
+            # kill the worker, and with all workers dead the producer blocks
+            # forever on the bounded queue instead of the run failing loudly.
+            try:
+                await score_one(ep)
+            except Exception as e:
+                task_id = ep.get("task_id", "unknown")
+                print(f"Episode {task_id} failed: {e}")
+
+    workers = [asyncio.create_task(worker()) for _ in range(args.concurrency)]
+    for ep in iter_episodes(args.input_file):
+        await queue.put(ep)
+    for _ in workers:
+        await queue.put(None)
+    await asyncio.gather(*workers)
+
+
+def run_batch(args, poll_interval: float = 30.0):
+    """
+    Submit all judge calls through the OpenAI-compatible Batch API instead of
+    the real-time endpoint. Judging is an offline audit job, so trading
+    latency (up to 24h completion window) for the ~50% batch discount and
+    freedom from real-time rate limits is usually the right call.
+    """
+    from openai import OpenAI
+
+    api_key = os.getenv("XAI_API_KEY")
+    if not api_key:
+        raise RuntimeError("Please set the XAI_API_KEY environment variable.")
+    client = OpenAI(api_key=api_key, base_url="https://api.x.ai/v1")
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    # One Batch API request per episode, keyed by task_id; episodes stream
+    # through one at a time so the whole file is never resident
+    n_episodes = 0
+    requests_path = os.path.join(args.output_dir, "batch_requests.jsonl")
+    with open(requests_path, "w") as f:
+        for ep in iter_episodes(args.input_file):
+            n_episodes += 1
+            f.write(
+                orjson.dumps(
+                    {
+                        "custom_id": str(ep.get("task_id", "unknown")),
+                        "method": "POST",
+                        "url": "/v1/chat/completions",
+                        "body": {
+                            "model": JUDGE_MODEL,
+                            "messages": [
+                                {"role": "system", "content": SYSTEM_PROMPT},
+                                {"role": "user", "content": build_judge_content(ep)},
+                            ],
+                            "temperature": 0.0,
+                        },
+                    }
+                ).decode()
+                + "\n"
+            )
+
+    with open(requests_path, "rb") as f:
+        input_file = client.files.create(file=f, purpose="batch")
+    job = client.batches.create(
+        input_file_id=input_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    print(f"Submitted batch job {job.id} ({n_episodes} episodes); polling...")
+
+    while job.status not in ("completed", "failed", "expired", "cancelled"):
+        time.sleep(poll_interval)
+        job = client.batches.retrieve(job.id)
+        print(f"[batch {job.id}] status: {job.status}")
+
+    if job.status != "completed":
+        raise RuntimeError(f"Batch job {job.id} finished with status {job.status}")
+
+    for line in client.files.content(job.output_file_id).text.splitlines():
+        if not line.strip():
+            continue
+        row = orjson.loads(line)
+        body = (row.get("response") or {}).get("body") or {}
+        choices = body.get("choices") or []
+        result = choices[0]["message"]["content"] if choices else ""
+
+        out_path = os.path.join(args.output_dir, f"{row.get('custom_id')}.txt")
         with open(out_path, "w") as out_f:
             out_f.write(result)
+        print(f"Scored episode {row.get('custom_id')}")
+
+
+def main():
+    args = parse_args()
+    if args.batch:
+        run_batch(args)
+        return
+    asyncio.run(run(args))
 
 
 if __name__ == "__main__":
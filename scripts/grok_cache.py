@@ -0,0 +1,41 @@
+"""
+On-disk exact-match response cache for the Grok audit scripts.
+
+Both scripts call Grok at near-zero temperature with prompts derived from
+static τ-Bench result files, so a re-run issues byte-identical requests.
+Caching responses keyed on the full request lets iteration re-runs replay
+from disk at zero latency and zero API cost.
+"""
+import os
+import json
+import hashlib
+
+
+class ResponseCache:
+    """A directory of JSON files, one per request, keyed by request hash."""
+
+    def __init__(self, cache_dir: str = ".grok_cache"):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key_obj) -> str:
+        digest = hashlib.blake2b(
+            json.dumps(key_obj, sort_keys=True).encode()
+        ).hexdigest()
+        return os.path.join(self.cache_dir, f"{digest}.json")
+
+    def get(self, key_obj):
+        """Return the cached value for `key_obj`, or None on a miss."""
+        try:
+            with open(self._path(key_obj), "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def set(self, key_obj, value) -> None:
+        # Write via a temp file so a crash can't leave a truncated entry.
+        path = self._path(key_obj)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(value, f)
+        os.replace(tmp_path, path)
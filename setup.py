@@ -11,6 +11,7 @@ setup(
     include_package_data=True,
     install_requires=[
         "openai>=1.13.3",
+        "httpx[http2]>=0.27.0",
         "mistralai>=0.4.0",
         "anthropic>=0.26.1",
         "google-generativeai>=0.5.4",
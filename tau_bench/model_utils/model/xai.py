@@ -1,4 +1,5 @@
 import os
+import weakref
 
 from tau_bench.model_utils.api.datapoint import Datapoint
 from tau_bench.model_utils.model.chat import ChatModel, Message
@@ -36,6 +37,25 @@ MAX_CONTEXT_LENGTH_MAP = {
 }
 MAX_CONTEXT_LENGTH_FALLBACK = 2_000_000
 
+# supports_dp/get_approx_cost are called repeatedly on the same datapoints,
+# and rebuilding the approximate prompt is the expensive part, so memoize the
+# token count per datapoint. Entries are keyed on id() but evicted via
+# weakref.finalize the moment the datapoint is collected: CPython reuses
+# addresses immediately, so an entry that outlived its object would silently
+# serve a stale count to whatever datapoint lands on the same address.
+_NUM_TOKENS_CACHE: dict[tuple[int, bool], int] = {}
+
+
+def _approx_num_tokens_for_dp(dp: Datapoint, include_response: bool) -> int:
+    key = (id(dp), include_response)
+    cached = _NUM_TOKENS_CACHE.get(key)
+    if cached is None:
+        prompt = approx_prompt_str(dp, include_response=include_response)
+        cached = approx_num_tokens(prompt)
+        _NUM_TOKENS_CACHE[key] = cached
+        weakref.finalize(dp, _NUM_TOKENS_CACHE.pop, key, None)
+    return cached
+
 
 class GrokModel(ChatModel):
     def __init__(
@@ -45,6 +65,7 @@ class GrokModel(ChatModel):
         temperature: float = 0.0,
     ) -> None:
         # xAI is OpenAI-compatible; we just change base_url + API key
+        import httpx
         from openai import AsyncOpenAI, OpenAI
 
         if model is None:
@@ -58,7 +79,20 @@ class GrokModel(ChatModel):
                 raise ValueError(f"{API_KEY_ENV_VAR} environment variable is not set")
 
         self.client = OpenAI(api_key=api_key, base_url=API_BASE_URL)
-        self.async_client = AsyncOpenAI(api_key=api_key, base_url=API_BASE_URL)
+        # One shared pool sized for high fan-out: agenerate_message callers
+        # may have hundreds of datapoints in flight at once
+        self.async_client = AsyncOpenAI(
+            api_key=api_key,
+            base_url=API_BASE_URL,
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=256, max_keepalive_connections=128
+                ),
+                # multiplex concurrent streams over few connections
+                # (requires the httpx[http2] extra)
+                http2=True,
+            ),
+        )
         self.temperature = temperature
 
     def generate_message(
@@ -83,11 +117,34 @@ class GrokModel(ChatModel):
             force_json=force_json,
         )
 
+    async def agenerate_message(
+        self,
+        messages: list[Message],
+        force_json: bool,
+        temperature: float | None = None,
+    ) -> Message:
+        # Async twin of generate_message: lets callers fan out over datapoints
+        # with asyncio.gather on one shared connection pool
+        if temperature is None:
+            temperature = self.temperature
+        msgs = self.build_generate_message_state(messages)
+        res = await self.async_client.chat.completions.create(
+            model=self.model,
+            messages=msgs,
+            temperature=wrap_temperature(temperature),
+            response_format={"type": "json_object" if force_json else "text"},
+        )
+        return self.handle_generate_message_response(
+            prompt=msgs,
+            content=res.choices[0].message.content,
+            force_json=force_json,
+        )
+
     def get_approx_cost(self, dp: Datapoint) -> float:
         cost_per_token = PRICE_PER_INPUT_TOKEN_MAP.get(
             self.model, INPUT_PRICE_PER_TOKEN_FALLBACK
         )
-        return approx_cost_for_datapoint(dp=dp, price_per_input_token=cost_per_token)
+        return cost_per_token * _approx_num_tokens_for_dp(dp, include_response=True)
 
     def get_latency(self, dp: Datapoint) -> float:
         latency_per_output_token = LATENCY_MS_PER_OUTPUT_TOKEN_MAP.get(
@@ -101,7 +158,6 @@ class GrokModel(ChatModel):
         return CAPABILITY_SCORE_MAP.get(self.model, CAPABILITY_SCORE_FALLBACK)
 
     def supports_dp(self, dp: Datapoint) -> bool:
-        prompt = approx_prompt_str(dp)
-        return approx_num_tokens(prompt) <= MAX_CONTEXT_LENGTH_MAP.get(
-            self.model, MAX_CONTEXT_LENGTH_FALLBACK
-        )
+        return _approx_num_tokens_for_dp(
+            dp, include_response=False
+        ) <= MAX_CONTEXT_LENGTH_MAP.get(self.model, MAX_CONTEXT_LENGTH_FALLBACK)